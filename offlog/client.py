@@ -1,17 +1,31 @@
 import os
 import builtins
-import io
 import socket
-import select
-from collections import deque
+import struct
 
 from . import DEFAULT_TIMEOUT, DEFAULT_SOCK_PATH
 
 BUFSIZE = 4096
+IOV_MAX = os.sysconf('SC_IOV_MAX')
+# Requested socket send buffer size. Linux caps this at the net.core.wmem_max sysctl:
+SNDBUF_SIZE = 4 << 20
 FILE_OK = b"OK"
 GOODBYE = b"BYE"
 ROTATED = b"ROTATED"
 
+def _timeval(ms):
+    # Pack a timeout in milliseconds as a struct timeval for SO_RCVTIMEO/SO_SNDTIMEO,
+    # with the same meaning as a poll() timeout: None or negative means no timeout, and
+    # zero means not to wait. A zero timeval means no timeout, so use the smallest
+    # nonzero one for the latter.
+    if ms is None or ms < 0:
+        return struct.pack('ll', 0, 0)
+    sec, usec = divmod(int(ms * 1000), 1_000_000)
+    if not (sec or usec):
+        usec = 1
+    return struct.pack('ll', sec, usec)
+
+
 def _make_exception(response):
     # Generate an exception object from a response from the server. Or return None if no
     # response
@@ -25,54 +39,35 @@ def _make_exception(response):
 
 
 class _ByteQueue:
-    """Class to queue unsent data. Stores data in a dequeue of BytesIO objects
-    containing up to BUFSIZE bytes each. All interior elements have exactly BUFSIZE
-    bytes each, but the first and last elements may have fewer. Idea is to call put() to
-    queue unsent data, to call peek() to get a chunk of data to be sent from the queue
-    without removing, and then to report how many bytes were successfully sent by
-    calling done(n), which clears the last n bytes from the queue. len() returns the
-    length of the queue in bytes."""
+    """Class to queue unsent data. Stores data in a single bytearray. Idea is to call
+    put() to queue unsent data, to call peek() to get the data to be sent from the
+    queue without removing or copying it, and then to report how many bytes were
+    successfully sent by calling done(n), which clears the first n bytes from the
+    queue. len() returns the length of the queue in bytes.
+
+    peek() returns a memoryview of the queue's storage, which must be released before
+    calling put() or done(), for example by using it as a context manager."""
 
     def __init__(self):
-        self.q = deque()
+        self.buf = bytearray()
 
     def __len__(self):
-        qlen = len(self.q)
-        if not qlen:
-            return 0
-        n = self.q[0].getbuffer().nbytes
-        if qlen > 1:
-            n += self.q[-1].getbuffer().nbytes
-        if qlen > 2:
-            n += BUFSIZE * (qlen - 2)
-        return n
+        return len(self.buf)
 
     def put(self, data):
         """Append data to the back of the queue"""
-        if self:  # non-empty
-            curr_chunk_nbytes_avail = BUFSIZE - self.q[-1].getbuffer().nbytes
-            if curr_chunk_nbytes_avail:
-                self.q[-1].write(data[:curr_chunk_nbytes_avail])
-                data = data[curr_chunk_nbytes_avail:]
-        while data:
-            chunk = io.BytesIO()
-            chunk.write(data[:BUFSIZE])
-            self.q.append(chunk)
-            data = data[BUFSIZE:]
+        self.buf += data
 
     def peek(self):
-        """Get up to BUFSIZE bytes from the front of the queue without removing them"""
-        return self.q[0].getvalue()
+        """Get a view of the data in the queue without removing it"""
+        return memoryview(self.buf)
 
     def done(self, n):
-        """Remove nbytes from the front of the queue"""
-        if not n:
-            return
-        chunk = self.q.popleft()
-        if n < chunk.getbuffer().nbytes:
-            newchunk = io.BytesIO()
-            newchunk.write(chunk.getvalue()[n:])
-            self.q.appendleft(newchunk)
+        """Remove n bytes from the front of the queue"""
+        # Deleting from the front of a bytearray just advances the start of its data
+        # within its allocation, which is only compacted when mostly unused. So this
+        # does not move the rest of the queue each time.
+        del self.buf[:n]
 
 
 class ProxyFile:
@@ -87,12 +82,23 @@ class ProxyFile:
     ):
         self.timeout = timeout
         self.sock_path = sock_path
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.setblocking(0)
-        self.poller = select.epoll()
-        self.poller.register(self.sock, select.EPOLLIN)
-        self._recv_buf = io.BytesIO()
         self._sendqueue = _ByteQueue()
+        self._recv_buf = bytearray()
+        # Preallocated buffer to receive into:
+        self._recv_scratch = memoryview(bytearray(BUFSIZE))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # The socket is in blocking mode, with blocking operations limited by the
+            # timeout. Operations that should not block at all pass MSG_DONTWAIT.
+            timeval = _timeval(timeout)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+            # A large send buffer lets bursts of writes go straight to the kernel
+            # rather than being queued by us while the server catches up:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SNDBUF_SIZE)
+        except Exception:
+            self.sock.close()
+            raise
         self._connect()
         self._open(filepath, block=block_open)
         self._rotated = False
@@ -107,30 +113,38 @@ class ProxyFile:
         except PermissionError:
             self.sock.close()
             raise
+        except BlockingIOError:
+            # Server's listen backlog remained full for the duration of the timeout
+            self.sock.close()
+            raise TimeoutError("timed out connecting to server") from None
 
-    def _recv_msg(self, timeout=None):
+    def _recv_msg(self, block=True):
         # recv until null byte. If timeout or EOF, raise but leave data read so far in
-        # self._recv_buf.
-        if timeout is None:
-            timeout = self.timeout
-        while self.poller.poll(timeout):
+        # self._recv_buf. If block=False, return None instead of waiting for data.
+        while True:
+            # Check for a complete message first, since more than one may have been
+            # received at once:
+            end = self._recv_buf.find(b'\0')
+            if end != -1:
+                msg = bytes(self._recv_buf[:end])
+                del self._recv_buf[: end + 1]
+                return msg
             try:
-                data = self.sock.recv(BUFSIZE)
+                n = self.sock.recv_into(
+                    self._recv_scratch, 0, 0 if block else socket.MSG_DONTWAIT
+                )
+            except BlockingIOError:
+                if not block:
+                    return None
+                self.sock.close()
+                raise TimeoutError("no response from server") from None
             except ConnectionResetError:
                 self.sock.close()
                 raise
-            msg, null, extradata = data.partition(b'\0')
-            self._recv_buf.write(msg)
-            if not data:
+            if not n:
                 self.sock.close()
                 raise EOFError
-            if null:
-                msg = self._recv_buf.getvalue()
-                self._recv_buf = io.BytesIO()
-                self._recv_buf.write(extradata)
-                return msg
-        self.sock.close()
-        raise TimeoutError("no response from server")
+            self._recv_buf += self._recv_scratch[:n]
 
     def _open(self, filepath, block=True):
         filepath = os.fsencode(filepath)
@@ -152,15 +166,16 @@ class ProxyFile:
         self._checkrecv()
         return self._rotated
 
-    def _checkrecv(self, timeout=0):
+    def _checkrecv(self):
         """Check if the server has sent us any messages. If it has sent a notification
         that the file was rotated, set self._rotated=True. If it's an error, raise it."""
-        while self.poller.poll(0):
-            # No possibility of getting a partial message (and therefore TimeoutError)
-            # because all messages the server sends are smaller than PIPE_BUF and
-            # therefore sent atomically
-            msg = self._recv_msg(timeout=0)
-            if msg == FILE_OK:
+        while True:
+            # No possibility of getting a partial message because all messages the
+            # server sends are smaller than PIPE_BUF and therefore sent atomically
+            msg = self._recv_msg(block=False)
+            if msg is None:
+                return
+            elif msg == FILE_OK:
                 # indicates sucessful file open, not previously read due to nonblocking
                 # _open(). ignore.
                 continue
@@ -171,11 +186,24 @@ class ProxyFile:
                 self.sock.close()
                 raise _make_exception(msg) from None
 
-    def _checksend(self, data):
+    def _checksend(self, data, flags=socket.MSG_DONTWAIT):
         """Send data and return number of bytes sent. If the server has closed the
         socket and sent us an error message, raise it."""
         try:
-            return self.sock.send(data)
+            return self.sock.send(data, flags)
+        except BrokenPipeError:
+            self._checkrecv()
+            raise # reraise if no error was raised by _checkrecv()
+        except ConnectionResetError:
+            self.sock.close()
+            raise
+
+    def _checksendmsg(self, buffers):
+        """Send a list of buffers with a single gather system call and return number of
+        bytes sent. If the server has closed the socket and sent us an error message,
+        raise it."""
+        try:
+            return self.sock.sendmsg(buffers, [], socket.MSG_DONTWAIT)
         except BrokenPipeError:
             self._checkrecv()
             raise # reraise if no error was raised by _checkrecv()
@@ -188,7 +216,8 @@ class ProxyFile:
         BrokenPipeError, check if the server sent us an error and raise it if so."""
         try:
             while self._sendqueue:  # while it's non-empty:
-                sent = self._checksend(self._sendqueue.peek())
+                with self._sendqueue.peek() as data:
+                    sent = self._checksend(data)
                 self._sendqueue.done(sent)
         except BlockingIOError:
             pass
@@ -199,22 +228,56 @@ class ProxyFile:
     def write(self, data):
         """Send as much as we can without blocking. If sending would block, queue unsent
         data for later. On BrokenPipeError, check if the server sent us an error and
-        raise it if so. This method will always attempt to re-send previously-queued
-        data before attempting to send new data."""
+        raise it if so. If there is previously-queued data, new data is queued after it
+        and as much of both as possible is sent at once."""
 
-        if not isinstance(data, bytes):
+        if isinstance(data, str):
             data = data.encode('utf8')
 
-        # Retry previously-queued data:
-        self._retry_queued()
+        if self._sendqueue:
+            # Queue new data after previously-queued data and send them together:
+            self._sendqueue.put(data)
+            self._retry_queued()
+            return
+        # Advance through a view of the data rather than copying what remains after
+        # each partial send:
+        view = memoryview(data)
+        try:
+            # Try sending new data:
+            while view:
+                sent = self._checksend(view)
+                view = view[sent:]
+        except BlockingIOError:
+            # Queue unsent data for later
+            self._sendqueue.put(view)
+
+    def writelines(self, lines):
+        """Like write(), but for an iterable of data, which is sent using as few system
+        calls as possible by passing multiple buffers to sendmsg() at once, rather than
+        requiring the caller to concatenate them first."""
+        buffers = [l.encode('utf8') if isinstance(l, str) else l for l in lines]
+
+        if self._sendqueue:
+            # Queue new data after previously-queued data and send them together:
+            for data in buffers:
+                self._sendqueue.put(data)
+            self._retry_queued()
+            return
         try:
             # Try sending new data:
-            while data:
-                sent = self._checksend(data)
-                data = data[sent:]
+            i = 0
+            while i < len(buffers):
+                sent = self._checksendmsg(buffers[i : i + IOV_MAX])
+                # Skip past fully-sent buffers and trim a partially-sent one:
+                while i < len(buffers) and sent >= len(buffers[i]):
+                    sent -= len(buffers[i])
+                    i += 1
+                if sent:
+                    buffers[i] = memoryview(buffers[i])[sent:]
         except BlockingIOError:
             # Queue unsent data for later
-            self._sendqueue.put(data)
+            for data in buffers[i:]:
+                self._sendqueue.put(data)
 
     def close(self, block_send=True, block_close=True):
         """Close the socket. Attempt to send all queued unsent data to the server and
@@ -233,21 +296,22 @@ class ProxyFile:
         the file for log rolling purposes (in which case you'd like this to be
         non-blocking unless something is very wrong), wheras at application shutdown you
         probably want block_send=True, block_close=True"""
-        if self.sock.fileno() == -1:
+        if getattr(self, 'sock', None) is None or self.sock.fileno() == -1:
             return
         try:
             # Attempt to flush unsent data:
-            poller = select.epoll()
-            poller.register(self.sock, select.EPOLLOUT)
             if block_send:
                 while self._sendqueue:
-                    if poller.poll(self.timeout):
-                        self._retry_queued()
-                    else:
+                    # A blocking send, subject to SO_SNDTIMEO:
+                    try:
+                        with self._sendqueue.peek() as data:
+                            sent = self._checksend(data, flags=0)
+                    except BlockingIOError:
                         raise TimeoutError(
-                        "timed out flushing unsent data on close(). "
-                        + f"{len(self._sendqueue)} bytes not sent."
-                    )
+                            "timed out flushing unsent data on close(). "
+                            + f"{len(self._sendqueue)} bytes not sent."
+                        ) from None
+                    self._sendqueue.done(sent)
             else:
                 self._retry_queued()
             self.sock.shutdown(socket.SHUT_WR)
@@ -1,7 +1,10 @@
 import sys
 import os
-from datetime import datetime
+import io
+import time
 import traceback
+import atexit
+import weakref
 from logging import DEBUG, INFO, WARNING, ERROR, CRITICAL
 
 from . import DEFAULT_SOCK_PATH, DEFAULT_TIMEOUT
@@ -15,6 +18,30 @@ _level_names = {
     DEBUG: 'DEBUG',
 }
 
+# The '.mmm' millisecond part of a timestamp, indexed by millisecond:
+_millis = [f".{ms:03d}" for ms in range(1000)]
+
+
+# All Loggers, so that any not yet closed can be closed at exit:
+_loggers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_all():
+    # Close all Loggers while the interpreter is still fully functional, rather than
+    # leaving it to __del__ during interpreter teardown
+    for logger in list(_loggers):
+        try:
+            logger.close()
+        except Exception:
+            traceback.print_exc()
+
+
+def _disabled(msg, *args, exc_info=False):
+    # Stands in for the logging methods of disabled levels. A plain function rather than
+    # a method, so that storing it on the instance does not create a reference cycle.
+    pass
+
 
 class Logger:
     def __init__(
@@ -27,6 +54,8 @@ class Logger:
         local_file=False,
         offlog_socket_path=DEFAULT_SOCK_PATH,
         offlog_timeout=DEFAULT_TIMEOUT,
+        buffer_size=0,
+        flush_interval=None,
     ):
         """Logging object to log to file, stdout and stderr, with optional proxying of
         file writes via a offlog server.
@@ -42,7 +71,18 @@ class Logger:
         `offlog_socket_path` is used to connect to a running offlog server, which will open the
         file for us, writes will be proxied through it. Any blocking operations communicating
         with the server (such as the initial file open, and flushing data at shutdown) will be
-        subject to a communications timeout of `offlog_timeout` in milliseconds, default 5000.
+        subject to a communications timeout of `offlog_timeout` in milliseconds, default 5000,
+        or None for no timeout.
+
+        If `buffer_size` is nonzero, records destined for the file are accumulated in a
+        local buffer and only written out once it holds at least `buffer_size` bytes, or
+        when `flush()` or `close()` is called. This reduces the number of system calls
+        made when logging many small records, at the cost of records not appearing in
+        the file in real time. The default of zero writes every record immediately.
+        If `flush_interval` is not None, the buffer is additionally written out when a
+        record is logged more than `flush_interval` milliseconds after the oldest
+        record in the buffer. There is no background thread, so this check happens only
+        when records are logged.
 
         UTF-8 encoding is assumed throughout."""
 
@@ -54,15 +94,62 @@ class Logger:
         self.offlog_socket_path = offlog_socket_path
         self.offlog_timeout = offlog_timeout
         self.local_file = local_file
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._wbuf = bytearray()
+        # monotonic time at which buffered records are due to be written out:
+        self._flush_deadline = None
+        # The part of each record's prefix that follows the timestamp, by level:
+        if name is not None:
+            self._prefixes = {l: f" {name} {n}] " for l, n in _level_names.items()}
+        else:
+            self._prefixes = {l: f" {n}] " for l, n in _level_names.items()}
+        # Cached date and time to the second, re-rendered only when the second changes:
+        self._ts_sec = None
+        self._ts = None
         self.minlevel = min(
             [l for l in [file_level, stdout_level, stderr_level] if l is not None]
         )
         self.file = self._open()
+        # The write methods of the outputs enabled for each level, worked out once here
+        # so that log() does not compare levels for every record. Methods are stored
+        # unbound to avoid a reference cycle delaying closing the file:
+        cls = type(self)
+        if buffer_size:
+            write_file = cls._write_file_buffered
+        elif local_file:
+            write_file = cls._write_file_local
+        else:
+            write_file = cls._write_file_proxied
+        self._writers = {}
+        for level in _level_names:
+            writers = []
+            if self.file is not None and level >= file_level:
+                writers.append(write_file)
+            if stderr_level is not None and level >= stderr_level:
+                writers.append(cls._write_stderr)
+            elif stdout_level is not None and level >= stdout_level:
+                writers.append(cls._write_stdout)
+            self._writers[level] = tuple(writers)
+        # Shadow methods for levels with no outputs with a no-op, so that disabled calls
+        # return immediately without calling log():
+        for level, method in [
+            (DEBUG, 'debug'),
+            (INFO, 'info'),
+            (WARNING, 'warning'),
+            (ERROR, 'error'),
+            (ERROR, 'exception'),
+            (CRITICAL, 'critical'),
+        ]:
+            if not self._writers[level]:
+                setattr(self, method, _disabled)
+        _loggers.add(self)
 
     def _open(self, block=True):
         if self.file_level is not None and self.filepath is not None:
             if self.local_file:
-                return open(self.filepath, 'a', encoding='utf8')
+                # Unbuffered, since we write whole records (or our own buffer of them):
+                return open(self.filepath, 'ab', buffering=0)
             else:
                 return ProxyFile(
                     self.filepath,
@@ -100,8 +187,39 @@ class Logger:
             self.close(block_send=True, block_close=False)
             self.file = self._open(block=False)
 
+    def _write(self, data):
+        if self.local_file:
+            self._write_local(data)
+        else:
+            self.file.write(data)
+
+    def _write_local(self, data):
+        # A raw file may in principle write only part of the data:
+        view = memoryview(data)
+        while view:
+            view = view[self.file.write(view) :]
+
+    def _write_stream(self, stream, msg):
+        stream.write(msg)
+        # A line-buffered stream has already flushed, since msg ends in a newline:
+        if not getattr(stream, 'line_buffering', False):
+            stream.flush()
+
+    def flush(self):
+        """Write out any records held in the local buffer. For a proxied file this does
+        not block, unsent data is queued by the `ProxyFile` as with any other write.
+        If writing fails, the exception is raised and the buffered records are
+        discarded."""
+        # Swap in a new buffer before writing, so that views of the old one referenced
+        # by the traceback of a failed write don't prevent buffering more records:
+        data, self._wbuf = self._wbuf, bytearray()
+        if data and getattr(self, 'file', None) is not None:
+            self._write(data)
+
     def close(self, block_send=True, block_close=True):
-        """Close the file. Possibly blocking. Idempotent.
+        """Close the file, first writing out any buffered records. Possibly blocking.
+        Idempotent. Called automatically at interpreter exit for any Logger not
+        already closed.
 
         For the case of a proxied file, optional arguments are (ignored for local file):
 
@@ -120,42 +238,63 @@ class Logger:
         non-blocking unless something is very wrong), wheras at application shutdown you
         probably want block_send=True, block_close=True"""
         if getattr(self, 'file', None) is not None:
+            self.flush()
             if self.local_file:
                 self.file.close()
             else:
                 self.file.close(block_send=block_send, block_close=block_close)
 
     def format(self, level, msg, *args, exc_info=None):
-        t = datetime.now().isoformat(sep=' ')[:-3]
-        if self.name is not None:
-            msg = f"[{t} {self.name} {_level_names[level]}] {msg}\n"
-        else:
-            msg = f"[{t} {_level_names[level]}] {msg}\n"
+        sec, ns = divmod(time.time_ns(), 1_000_000_000)
+        if sec != self._ts_sec:
+            self._ts = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+            self._ts_sec = sec
         if args:
             msg %= args
+        msg = f"[{self._ts}{_millis[ns // 1_000_000]}{self._prefixes[level]}{msg}\n"
         if exc_info:
             if isinstance(exc_info, BaseException):
                 exc_info = (type(exc_info), exc_info, exc_info.__traceback__)
             elif not isinstance(exc_info, tuple):
                 exc_info = sys.exc_info()
-            msg += ''.join(traceback.format_exception(*exc_info))
+            buf = io.StringIO()
+            buf.write(msg)
+            traceback.print_exception(*exc_info, file=buf)
+            msg = buf.getvalue()
         return msg
 
     def log(self, level, msg, *args, exc_info=False):
-        if level < self.minlevel:
+        writers = self._writers.get(level, ())
+        if not writers:
             return
         self._check_rotated()
         msg = self.format(level, msg, *args, exc_info=exc_info)
-        if self.file is not None and level >= self.file_level:
-            self.file.write(msg)
-            if self.local_file:
-                self.file.flush()
-        if self.stderr_level is not None and level >= self.stderr_level:
-            sys.stderr.write(msg)
-            sys.stderr.flush()
-        elif self.stdout_level is not None and level >= self.stdout_level:
-            sys.stdout.write(msg)
-            sys.stdout.flush()
+        for write in writers:
+            write(self, msg)
+
+    # Records are encoded once, the file object is given bytes:
+
+    def _write_file_buffered(self, msg):
+        if not self._wbuf and self.flush_interval is not None:
+            self._flush_deadline = time.monotonic() + self.flush_interval / 1000
+        self._wbuf += msg.encode('utf8')
+        if len(self._wbuf) >= self.buffer_size or (
+            self._flush_deadline is not None
+            and time.monotonic() >= self._flush_deadline
+        ):
+            self.flush()
+
+    def _write_file_local(self, msg):
+        self._write_local(msg.encode('utf8'))
+
+    def _write_file_proxied(self, msg):
+        self.file.write(msg.encode('utf8'))
+
+    def _write_stderr(self, msg):
+        self._write_stream(sys.stderr, msg)
+
+    def _write_stdout(self, msg):
+        self._write_stream(sys.stdout, msg)
 
     def debug(self, msg, *args, exc_info=False):
         self.log(DEBUG, msg, *args, exc_info=exc_info)
@@ -6,14 +6,28 @@ import time
 import select
 import traceback
 import signal
-import io
 import ctypes
 import ctypes.util
 
 from . import DEFAULT_SOCK_PATH, DEFAULT_ROTATE_CHECK_INTERVAL, Logger
 
-BUFSIZE = 4096
+BUFSIZE = 1 << 16
 PATH_MAX = os.pathconf('/', 'PC_PATH_MAX')
+IOV_MAX = os.sysconf('SC_IOV_MAX')
+# Size at which the server's own log is written out before the end of a loop iteration:
+LOG_BUFFER_SIZE = 1 << 16
+# Maximum number of receive buffers kept for reuse:
+BUFFER_POOL_SIZE = 64
+# Reads shorter than this are copied out of the receive buffer, so that the buffer can
+# be reused immediately instead of being held until the data is written:
+COPY_THRESHOLD = BUFSIZE // 4
+# How many bytes to write to a file between advising the kernel to drop its cached
+# pages. Log files are rarely read back, so there's no point them filling the page
+# cache:
+FADVISE_INTERVAL = 8 << 20
+# Size of struct signalfd_siginfo, and of glibc's sigset_t:
+SIGINFO_SIZE = 128
+SIGSET_SIZE = 128
 
 # Possible messages to the client. Other messages are possible, if we catch an exception
 # opening or writing to a file and return it to the client.
@@ -28,9 +42,15 @@ ROTATED = b"ROTATED"
 CONNECTION_ACTIVE = 0
 CLIENT_CLOSED_CONNECTION = 1
 SERVER_TO_CLOSE_CONNECTION = 2
+# Writing to the client's file failed. All clients with data pending for the file are to
+# be sent the error and disconnected:
+WRITE_FAILED = 3
 
 logger = None
 
+# Receive buffers no longer in use, for reuse rather than allocating new ones:
+_buffers = []
+
 
 def _format_exc():
     # Format just the last line of the current exception, not the whole traceback
@@ -47,42 +67,218 @@ def _systemd_notify():
     libsystemd.sd_notify(0, b'READY=1')
 
 
+def _signalfd(signals):
+    # Create a non-blocking signalfd to receive the given signals, which the caller must
+    # block. Python does not wrap signalfd(), so call it from libc:
+    libc = ctypes.CDLL(None, use_errno=True)
+    mask = ctypes.create_string_buffer(SIGSET_SIZE)
+    libc.sigemptyset(mask)
+    for signum in signals:
+        libc.sigaddset(mask, signum)
+    fd = libc.signalfd(-1, mask, os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd == -1:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return fd
+
+
 def _time_ms():
     return time.monotonic_ns() // 1_000_000
 
 
+def _get_buffer():
+    # Get a receive buffer from the pool, or a new one if the pool is empty
+    if _buffers:
+        return _buffers.pop()
+    return bytearray(BUFSIZE)
+
+
+def _release_buffer(data):
+    # Release a view of a receive buffer, returning the buffer to the pool. Data copied
+    # out of a receive buffer is bytes, possibly viewed by a memoryview if it was
+    # partially written, and is left to the garbage collector.
+    if isinstance(data, memoryview):
+        buf = data.obj
+        data.release()
+        if isinstance(buf, bytearray) and len(_buffers) < BUFFER_POOL_SIZE:
+            _buffers.append(buf)
+
+
 class FileHandler:
-    def __init__(self, filepath, client_id):
+    """Class representing an open file, shared by all clients writing to it"""
+
+    __slots__ = (
+        'filepath',
+        'name',
+        'fd',
+        'clients',
+        'writers',
+        'failure',
+        'rotated',
+        'pending',
+        'written',
+    )
+
+    # Mapping of file paths to FileHandlers for open files that have not been rotated:
+    instances = {}
+
+    @classmethod
+    def instance(cls, filepath):
+        """Get the FileHandler for the given path, opening the file if there is not
+        already one"""
+        try:
+            return cls.instances[filepath]
+        except KeyError:
+            filehandler = cls.instances[filepath] = cls(filepath)
+            return filehandler
+
+    @classmethod
+    def check_all_rotated(cls):
+        """Check whether any open files have been rotated"""
+        for filehandler in list(cls.instances.values()):
+            filehandler.check_rotated()
+
+    def __init__(self, filepath):
+        # The path as received from the client, as bytes, used as is for checking for
+        # rotation. Decoded for logging, and for opening so that errors show the path
+        # as a string:
         self.filepath = filepath
-        self.client_id = client_id
-        self.file = open(self.filepath, 'ab')
-        logger.info("Client %d opened %s", self.client_id, self.filepath)
+        self.name = os.fsdecode(filepath)
+        self.fd = os.open(self.name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        # Sessions using the file, and those of them with data in self.pending:
+        self.clients = set()
+        self.writers = set()
+        # Error message and the clients whose data was discarded, from a failed write
+        # not yet reported to them:
+        self.failure = None
         self.rotated = False
+        # Data received but not yet written, to be written all at once by flush():
+        self.pending = []
+        # Bytes written since we last advised the kernel to drop cached pages:
+        self.written = 0
 
     def check_rotated(self):
         try:
-            if os.stat(self.file.fileno()).st_ino != os.stat(self.filepath).st_ino:
+            if os.stat(self.fd).st_ino != os.stat(self.filepath).st_ino:
                 self.rotated = True
         except FileNotFoundError:
             self.rotated = True
         if self.rotated:
-            logger.info("File rotation detected: %s", self.filepath)
+            logger.info("File rotation detected: %s", self.name)
+            # Clients opening this path from now on get a new file:
+            del self.instances[self.filepath]
         return self.rotated
 
-    def write(self, msg):
-        self.file.write(msg)
-        self.file.flush()
+    def new_client(self, client):
+        self.clients.add(client)
+        logger.info(
+            "New client %d (total: %d) for %s",
+            client.id,
+            len(self.clients),
+            self.name,
+        )
+
+    def client_done(self, client):
+        # Remove a client, closing the file if it was the last one. Data it sent that is
+        # still pending will be written with the next flush.
+        self.clients.remove(client)
+        self.writers.discard(client)
+        logger.info(
+            "Client %d done (remaining: %d) with %s",
+            client.id,
+            len(self.clients),
+            self.name,
+        )
+        if not self.clients:
+            self.close()
+
+    def write(self, client, msg):
+        # msg is bytes, or a view of a receive buffer that is returned to the pool once
+        # written
+        self.pending.append(msg)
+        self.writers.add(client)
+        if len(self.pending) >= IOV_MAX:
+            self.flush()
+
+    def flush(self):
+        # Write pending data with as few system calls as possible:
+        pending = self.pending
+        if not pending:
+            # Nothing to write, possibly because the file was closed since being marked
+            # as needing a flush
+            return
+        while pending:
+            try:
+                written = os.writev(self.fd, pending[:IOV_MAX])
+            except OSError:
+                self.write_failed()
+                raise
+            self.written += written
+            # Drop fully-written buffers and trim a partially-written one:
+            i = 0
+            while i < len(pending) and written >= len(pending[i]):
+                written -= len(pending[i])
+                i += 1
+            for view in pending[:i]:
+                _release_buffer(view)
+            del pending[:i]
+            if written:
+                pending[0] = memoryview(pending[0])[written:]
+        self.writers.clear()
+        if self.written >= FADVISE_INTERVAL:
+            self.drop_cache()
+
+    def drop_cache(self):
+        # Ask the kernel to drop cached pages of the file. Pages still waiting to be
+        # written back are not dropped, but those written in previous intervals are.
+        self.written = 0
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                # Only advisory, and not supported for all file types
+                pass
+
+    def write_failed(self):
+        # Log the current exception and discard pending data, so that it is not
+        # retried. Keep the error message and the clients whose data was discarded for
+        # the server to report the failure to them.
+        emsg = _format_exc()
+        logger.warning("Failed to write to %s:\n%s", self.name, emsg)
+        for view in self.pending:
+            _release_buffer(view)
+        self.pending.clear()
+        self.failure = (emsg, self.writers)
+        self.writers = set()
 
     def close(self):
-        if self.file is not None:
-            self.file.close()
-            logger.info("Client %d closed %s", self.client_id, self.filepath)
-            self.file = None
+        if self.fd is not None:
+            # All clients are done, so there is no one to report a failure to:
+            try:
+                self.flush()
+            except OSError:
+                self.failure = None
+            os.close(self.fd)
+            logger.info("Closed %s", self.name)
+            self.fd = None
+            if self.instances.get(self.filepath) is self:
+                del self.instances[self.filepath]
 
 
 class Session:
     """Class representing a connected client"""
 
+    __slots__ = (
+        'id',
+        'sock',
+        'fd',
+        'filehandler',
+        '_recv_buf',
+        '_shutting_down',
+        '_notified_rotated',
+        '_handle_data',
+    )
+
     _next_client_id = 0
 
     def __init__(self, sock):
@@ -90,13 +286,19 @@ class Session:
         self.__class__._next_client_id += 1
         self.sock = sock
         self.sock.setblocking(0)
+        self.fd = sock.fileno()
         self.filehandler = None
-        self._recv_buf = io.BytesIO()
+        self._recv_buf = bytearray()
         self._shutting_down = False
+        # Whether we've told the client its file has been rotated:
+        self._notified_rotated = False
+        # Handler for received data, depending on whether we've opened a file yet.
+        # Stored unbound to avoid a reference cycle:
+        self._handle_data = Session.handle_filepath
 
     def close(self):
         if self.filehandler is not None:
-            self.filehandler.close()
+            self.filehandler.client_done(self)
             self.filehandler = None
         self.sock.close()
 
@@ -104,7 +306,8 @@ class Session:
         status = self.do_send(ERR_SHUTDOWN)
         self.sock.shutdown(socket.SHUT_RD)
         self._shutting_down = True
-        return status or CONNECTION_ACTIVE  # will close once we've read remaining data
+        # Read remaining data now, as we may not get another event for this socket:
+        return status or self.do_recv()
 
     def do_send(self, msg):
         # Send null-terminated message to the client without blocking, return None on
@@ -117,6 +320,15 @@ class Session:
         except (BrokenPipeError, ConnectionResetError):
             return CLIENT_CLOSED_CONNECTION
 
+    def do_flush(self):
+        # Write data received since the last flush
+        if self.filehandler is not None:
+            try:
+                self.filehandler.flush()
+            except OSError:
+                return WRITE_FAILED
+        return CONNECTION_ACTIVE
+
     def check_rotated(self):
         if self._shutting_down:
             # Do nothing if shutting down
@@ -124,48 +336,68 @@ class Session:
         if self.filehandler is None:
             # Do nothing if we don't have an open file
             return CONNECTION_ACTIVE
-        if self.filehandler.rotated:
+        if self._notified_rotated:
             # Do nothing if we've already told the client the file has been rotated
             return CONNECTION_ACTIVE
-        if self.filehandler.check_rotated():
+        if self.filehandler.rotated:
             # Tell the client the file has been rotated:
+            self._notified_rotated = True
             return self.do_send(ROTATED) or CONNECTION_ACTIVE
         return CONNECTION_ACTIVE
 
     def do_recv(self):
-        # Read data from the client
-        try:
-            data = self.sock.recv(BUFSIZE)
-        except ConnectionResetError:
-            return CLIENT_CLOSED_CONNECTION
-        if not data:
-            if self._shutting_down:
-                # Finished reading remaining data from client during server shutdown
-                return SERVER_TO_CLOSE_CONNECTION
+        # Read data from the client until there is none left, since the socket is
+        # registered for edge-triggered notifications
+        while True:
+            buf = _get_buffer()
+            try:
+                n = self.sock.recv_into(buf)
+            except BlockingIOError:
+                _buffers.append(buf)
+                return CONNECTION_ACTIVE
+            except ConnectionResetError:
+                _buffers.append(buf)
+                return CLIENT_CLOSED_CONNECTION
+            if not n:
+                _buffers.append(buf)
+                return self.handle_eof()
+            if n < COPY_THRESHOLD:
+                # Copy short reads, and reuse the buffer:
+                data = memoryview(buf)[:n].tobytes()
+                _buffers.append(buf)
             else:
-                # Client-initiated shutdown
-                return self.do_send(GOODBYE) or CLIENT_CLOSED_CONNECTION
+                # Pass on a view of the buffer rather than copying it. Buffers not
+                # passed to a FileHandler are left to the garbage collector:
+                data = memoryview(buf)[:n]
+            status = self._handle_data(self, data)
+            if status != CONNECTION_ACTIVE:
+                return status
 
-        # If we already have an open file, write the data:
-        if self.filehandler is not None:
-            try:
-                self.filehandler.write(data)
-            except OSError:
-                emsg = _format_exc()
-                logger.warning(
-                    "Failed to write to %s:\n%s", self.filehandler.filepath, emsg
-                )
-                return self.do_send(emsg.encode('utf8')) or SERVER_TO_CLOSE_CONNECTION
-            return CONNECTION_ACTIVE
+    def handle_eof(self):
+        if self._shutting_down:
+            # Finished reading remaining data from client during server shutdown
+            return SERVER_TO_CLOSE_CONNECTION
+        # Client-initiated shutdown. Write all their data before saying goodbye:
+        return self.do_flush() or self.do_send(GOODBYE) or CLIENT_CLOSED_CONNECTION
 
-        # Otherwise we're reading a null-terminated filepath from the client:
-        msg, null, extradata = data.partition(b'\0')
+    def handle_file_data(self, data):
+        # We have an open file, write the data:
+        try:
+            self.filehandler.write(self, data)
+        except OSError:
+            return WRITE_FAILED
+        return CONNECTION_ACTIVE
+
+    def handle_filepath(self, data):
+        # We're reading a null-terminated filepath from the client. Copying is fine,
+        # this happens once per connection:
+        msg, null, extradata = bytes(data).partition(b'\0')
 
         # Add to any previously-received data:
-        self._recv_buf.write(msg)
+        self._recv_buf += msg
 
         # Check if we've received too much data:
-        if self._recv_buf.getbuffer().nbytes > PATH_MAX:
+        if len(self._recv_buf) > PATH_MAX:
             logger.warning('Client %d error, path too long', self.id)
             return self.do_send(ERR_PATH_TOO_LONG) or SERVER_TO_CLOSE_CONNECTION
 
@@ -174,26 +406,35 @@ class Session:
             return CONNECTION_ACTIVE
 
         # We are done reading a filepath
-        path = os.fsdecode(self._recv_buf.getvalue())
-        self._recv_buf = io.BytesIO()
+        path = bytes(self._recv_buf)
+        del self._recv_buf[:]
 
         # Check it's an absolute path:
-        if not path.startswith('/'):
-            logger.warning('Client %d error, not an absolute path: %s', self.id, path)
+        if not path.startswith(b'/'):
+            name = os.fsdecode(path)
+            logger.warning('Client %d error, not an absolute path: %s', self.id, name)
             return self.do_send(ERR_NABSPATH) or SERVER_TO_CLOSE_CONNECTION
 
         # Try opening the file:
         try:
-            self.filehandler = FileHandler(path, self.id)
+            self.filehandler = FileHandler.instance(path)
         except OSError:
             emsg = _format_exc()
-            logger.warning('Client %d access denied for %s:\n%s', self.id, path, emsg)
+            name = os.fsdecode(path)
+            logger.warning('Client %d access denied for %s:\n%s', self.id, name, emsg)
             return self.do_send(emsg.encode('utf8')) or SERVER_TO_CLOSE_CONNECTION
+        logger.info(
+            'Client %d access confirmed for %s', self.id, self.filehandler.name
+        )
+        self.filehandler.new_client(self)
+        self._handle_data = Session.handle_file_data
 
         if extradata:
             # Client sent through some data to be written without waiting for a
             # response. That's fine, write the data:
-            self.filehandler.write(extradata)
+            status = self.handle_file_data(extradata)
+            if status != CONNECTION_ACTIVE:
+                return status
 
         return self.do_send(FILE_OK) or CONNECTION_ACTIVE
 
@@ -206,9 +447,15 @@ class Server:
         systemd_notify=False,
         rotate_check_interval=DEFAULT_ROTATE_CHECK_INTERVAL,
     ):
-        # Create a logger for the server itself
+        # Create a logger for the server itself. Its file output is buffered, and
+        # written once per iteration of the mainloop rather than once per record:
         global logger
-        logger = Logger(name='offlog', filepath=log_path, local_file=True)
+        logger = Logger(
+            name='offlog',
+            filepath=log_path,
+            local_file=True,
+            buffer_size=LOG_BUFFER_SIZE,
+        )
 
         self.systemd_notify = systemd_notify
         self.rotate_check_interval = rotate_check_interval
@@ -218,26 +465,35 @@ class Server:
         self.listen_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         self.listen_sock.setblocking(0)
         self.listen_sock.bind(str(self.sock_path))
+        self.listen_fd = self.listen_sock.fileno()
 
-        # A pipe we can use to signal shutdown from a signal handler
-        self.selfpipe_reader, self.selfpipe_writer = os.pipe()
+        # File descriptor from which to read shutdown signals, if we're handling them:
+        self.signal_fd = None
 
         self.poller = select.epoll()
-        self.poller.register(self.listen_sock, select.EPOLLIN)
-        self.poller.register(self.selfpipe_reader, select.EPOLLIN)
+        self.poller.register(self.listen_sock, select.EPOLLIN | select.EPOLLET)
 
         # Mapping of socket file descriptors to Session objects for connected clients
         self.clients = {}
 
+        # FileHandlers that have received data that has not yet been written:
+        self.dirty = set()
+
         # When to next check whether files have been rotated:
         self.t_next_rotate_check_ms = _time_ms() + self.rotate_check_interval
 
     def handle_client_connect(self):
-        client_sock, _ = self.listen_sock.accept()
-        client = Session(client_sock)
-        self.clients[client_sock.fileno()] = client
-        self.poller.register(client.sock, select.EPOLLIN)
-        logger.info("Client %d connected", client.id)
+        # Accept all pending connections, since the listening socket is registered for
+        # edge-triggered notifications
+        while True:
+            try:
+                client_sock, _ = self.listen_sock.accept()
+            except BlockingIOError:
+                return
+            client = Session(client_sock)
+            self.clients[client.fd] = client
+            self.poller.register(client.fd, select.EPOLLIN | select.EPOLLET)
+            logger.info("Client %d connected", client.id)
 
     def handle_client_disconnect(self, client, reason):
         if reason == SERVER_TO_CLOSE_CONNECTION:
@@ -246,50 +502,89 @@ class Server:
             logger.info("Client %d disconnected", client.id)
         else:
             raise ValueError(reason)
-        del self.clients[client.sock.fileno()]
+        del self.clients[client.fd]
         client.close()
 
+    def handle_write_failure(self, filehandler, client=None):
+        # Send the error to all clients whose data failed to be written, and the client
+        # whose write or flush raised it, if any, and disconnect them
+        emsg, clients = filehandler.failure
+        filehandler.failure = None
+        if client is not None:
+            clients.add(client)
+        for client in clients:
+            status = client.do_send(emsg.encode('utf8')) or SERVER_TO_CLOSE_CONNECTION
+            self.handle_client_disconnect(client, status)
+
+    def handle_status(self, client, status):
+        # Act on a client's state after receiving data from it or sending it a message
+        if status == WRITE_FAILED:
+            self.handle_write_failure(client.filehandler, client)
+        elif status != CONNECTION_ACTIVE:
+            self.handle_client_disconnect(client, status)
+
+    def handle_client_data(self, client, status):
+        # Act on a client's state after reading data from it, first marking its file
+        # as needing a flush, even if the client has disconnected:
+        if client.filehandler is not None:
+            self.dirty.add(client.filehandler)
+        self.handle_status(client, status)
+
     def run(self):
         self.listen_sock.listen()
 
         logger.info("This is offlog server")
         logger.info("Listening on socket %s", self.sock_path)
 
+        logger.flush()
+
         if self.systemd_notify:
             _systemd_notify()
 
         while True:
             timeout = max(0, self.t_next_rotate_check_ms - _time_ms())
-            events = self.poller.poll(timeout)
+            events = self.poller.poll(timeout / 1000)
             if events:
                 for fd, _ in events:
-                    if fd == self.listen_sock.fileno():
+                    # Check for client data first, since it's the most common event:
+                    client = self.clients.get(fd)
+                    if client is not None:
+                        self.handle_client_data(client, client.do_recv())
+                    elif fd == self.listen_fd:
                         self.handle_client_connect()
-                    elif fd == self.selfpipe_reader:
+                    elif fd == self.signal_fd:
                         # Shutting down. We will process remaining data before exiting
                         # the mainloop.
-                        logger.info("Received signal, shutting down")
+                        siginfo = os.read(self.signal_fd, SIGINFO_SIZE)
+                        signum = int.from_bytes(siginfo[:4], sys.byteorder)
+                        name = signal.Signals(signum).name
+                        logger.info("Received %s, shutting down", name)
                         self.shutdown()
-                    else:
-                        # Data from a client:
-                        client = self.clients[fd]
-                        status = client.do_recv()
-                        if status != CONNECTION_ACTIVE:
-                            self.handle_client_disconnect(client, status)
+                # Write all data received during this iteration:
+                while self.dirty:
+                    filehandler = self.dirty.pop()
+                    try:
+                        filehandler.flush()
+                    except OSError:
+                        self.handle_write_failure(filehandler)
             else:
-                for client in self.clients.values():
-                    status = client.check_rotated()
-                    if status != CONNECTION_ACTIVE:
-                        self.handle_client_disconnect(client, status)
+                FileHandler.check_all_rotated()
+                for client in list(self.clients.values()):
+                    self.handle_status(client, client.check_rotated())
                 self.t_next_rotate_check_ms = _time_ms() + self.rotate_check_interval
             if self.listen_sock.fileno() == -1 and not self.clients:
                 # Finished shutting down
                 logger.info("Exit")
+                logger.flush()
                 break
+            # Write our own log records from this iteration:
+            logger.flush()
 
     def shutdown(self):
-        os.close(self.selfpipe_reader)
-        os.close(self.selfpipe_writer)
+        # Signals remain blocked, so any further ones are ignored:
+        if self.signal_fd is not None:
+            os.close(self.signal_fd)
+            self.signal_fd = None
 
         # Stop accepting new connections
         self.listen_sock.close()
@@ -298,13 +593,16 @@ class Server:
         # Shutdown sockets for receiving new data. Mainloop will keep running to process
         # remaining data, then exit once there are no more clients with unread data
         # left.
-        for client in self.clients.values():
-            status = client.do_shutdown()
-            if status != CONNECTION_ACTIVE:
-                self.handle_client_disconnect(client, status)
+        for client in list(self.clients.values()):
+            # Skip clients disconnected due to a write failure on another's behalf:
+            if self.clients.get(client.fd) is client:
+                self.handle_client_data(client, client.do_shutdown())
 
     def connect_shutdown_handler(self):
         """Handle SIGINT and SIGTERM to shutdown gracefully"""
-        shutdown = lambda *_: os.write(self.selfpipe_writer, b'\0')
-        signal.signal(signal.SIGINT, shutdown)
-        signal.signal(signal.SIGTERM, shutdown)
+        # Block the signals and receive them from a signalfd in the mainloop instead,
+        # rather than having signal handlers interrupt it:
+        signals = {signal.SIGINT, signal.SIGTERM}
+        self.signal_fd = _signalfd(signals)
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        self.poller.register(self.signal_fd, select.EPOLLIN)